@@ -0,0 +1,126 @@
+#run batch (NDJSON stream, one line per question as it completes):
+#curl -N -X POST http://127.0.0.1:8000/query/batch -H "Content-Type: application/json" \
+#  -d '{"source_id": "manual.pdf", "questions": [{"question": "How do I reset it?"}]}'
+
+import asyncio
+import logging
+import os
+from data_loader import get_async_client
+from retrieval_pipeline import get_pipeline
+from scheduler import scheduler
+from query_engine import answer_messages, ANSWER_MODEL
+from custom_types import RAGBatchQuery
+
+logger = logging.getLogger("rag")
+
+# questions retrieved together; bounds the embedding request, the BM25
+# score matrix and the rerank batch, and lets answers stream per micro-batch
+MICRO_BATCH_SIZE = int(os.getenv("RAG_BATCH_MICRO_SIZE", 256))
+
+
+def _group_by_source(batch: RAGBatchQuery):
+    groups = {}
+    for index, q in enumerate(batch.questions):
+        source_id = q.source_id or batch.source_id
+        groups.setdefault(source_id, []).append((index, q))
+    return groups
+
+
+def _retrieve_group(source_id: str, questions: list[str], top_k: int):
+    # CPU and blocking I/O, runs on the scheduler's worker pool
+    pipeline = get_pipeline(source_id)
+    return pipeline.retrieve_batch(questions, top_k)
+
+
+async def generate_answer(client, question: str, contexts: list[str]) -> str:
+    res = await client.chat.completions.create(
+        model=ANSWER_MODEL,
+        max_completion_tokens=1024,
+        messages=answer_messages(question, contexts),
+    )
+    return res.choices[0].message.content.strip()
+
+
+async def run_batch(batch: RAGBatchQuery):
+    # Retrieval is batched per source_id in micro-batches (no query rewrite or multi-hop, those
+    # are one LLM call per question); answers run with bounded concurrency
+    # and results are yielded per question in completion order.
+    queue = asyncio.Queue()
+    semaphore = asyncio.Semaphore(max(batch.concurrency, 1))
+    client = get_async_client()
+
+    def result(index, q, source_id, **fields):
+        return {
+            "index": index,
+            "id": q.id,
+            "source_id": source_id,
+            "question": q.question,
+            **fields,
+        }
+
+    async def answer(index, q, source_id, contexts, sources, mode):
+        try:
+            if not contexts:
+                text = "No relevant context found."
+            else:
+                async with semaphore, scheduler.llm_slot():
+                    text = await generate_answer(client, q.question, contexts)
+            await queue.put(result(
+                index, q, source_id,
+                answer=text, sources=sources,
+                num_contexts=len(contexts), mode=mode,
+            ))
+        except Exception as e:
+            logger.error(f"Batch answer {index} failed: {e}")
+            await queue.put(result(index, q, source_id, error=str(e)))
+
+    # answer tasks live outside produce() so cancellation can reach them
+    tasks = []
+
+    async def produce():
+        try:
+            for source_id, group in _group_by_source(batch).items():
+                if source_id is None:
+                    for index, q in group:
+                        await queue.put(result(index, q, None, error="missing source_id"))
+                    continue
+                for start in range(0, len(group), MICRO_BATCH_SIZE):
+                    await retrieve_micro_batch(source_id, group[start:start + MICRO_BATCH_SIZE])
+            await asyncio.gather(*tasks)
+        finally:
+            await queue.put(None)
+
+    async def retrieve_micro_batch(source_id, items):
+        try:
+            retrieved = await scheduler.run_blocking(
+                _retrieve_group, source_id,
+                [q.question for _, q in items], batch.top_k,
+            )
+        except Exception as e:
+            logger.error(f"Batch retrieval for {source_id} failed: {e}")
+            for index, q in items:
+                await queue.put(result(index, q, source_id, error=str(e)))
+            return
+
+        logger.info(f"Retrieved {len(items)} questions for {source_id}")
+        # answers for this micro-batch start while the next one retrieves
+        for (index, q), (contexts, sources, mode) in zip(items, retrieved):
+            tasks.append(asyncio.create_task(
+                answer(index, q, source_id, contexts, sources, mode)
+            ))
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            yield item
+    finally:
+        # consumer gone: stop retrieval and any answers still calling OpenAI
+        if not producer.done():
+            producer.cancel()
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(producer, *tasks, return_exceptions=True)
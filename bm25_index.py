@@ -1,35 +1,105 @@
 from rank_bm25 import BM25Okapi
+import numpy as np
 import re
 
 class BM25Index:
 
     def __init__(self):
-        self.corpus = []
+        self.keys = []
         self.tokenized = []
         self.sources = []
         self.bm25 = None
+        self.postings = None
+        self.positions = {}
 
     def _tokenize(self, text: str):
         text = text.lower()
         return re.findall(r"\w+", text)
 
-    def build(self, contexts: list[str], sources: list[str]):
-        self.corpus = contexts
+    def build(self, contexts: list[str], sources: list[str], keys: list | None = None):
+        # keys identify hits returned by search; default to the text itself.
+        # With docstore chunk ids the corpus text is not kept in memory.
         self.sources = sources
         self.tokenized = [self._tokenize(c) for c in contexts]
+        self.keys = list(keys) if keys is not None else contexts
+        self.positions = {k: i for i, k in enumerate(self.keys)}
         self.bm25 = BM25Okapi(self.tokenized)
+        self.postings = None
 
     def search(self, query: str, top_k: int):
+        return self.search_with_scores(query, top_k)[0]
+
+    def search_with_scores(self, query: str, top_k: int):
+        # hits plus the score of every indexed chunk, so later stages can
+        # look candidates up instead of scoring the corpus again
         if not self.bm25:
-            return []
+            return [], None
 
         tokens = self._tokenize(query)
         scores = self.bm25.get_scores(tokens)
 
         ranked = sorted(
-            zip(self.corpus, scores),
+            zip(self.keys, scores),
             key=lambda x: x[1],
             reverse=True
         )
 
-        return [c for c, _ in ranked[:top_k]]
+        return [c for c, _ in ranked[:top_k]], scores
+
+    def _build_postings(self):
+        # term -> (doc indices, precomputed BM25 term weight), same formula
+        # as BM25Okapi.get_scores but without its per-document Python loop
+        bm25 = self.bm25
+        doc_len = np.asarray(bm25.doc_len, dtype=float)
+        norm = bm25.k1 * (1 - bm25.b + bm25.b * doc_len / bm25.avgdl)
+        entries = {}
+        for d, freqs in enumerate(bm25.doc_freqs):
+            for term, tf in freqs.items():
+                entries.setdefault(term, ([], []))
+                entries[term][0].append(d)
+                entries[term][1].append(tf)
+
+        # built locally and published in one assignment: pipelines are shared
+        # across worker threads, which must never see a half-filled dict
+        postings = {}
+        for term, (docs, tfs) in entries.items():
+            docs = np.asarray(docs)
+            tfs = np.asarray(tfs, dtype=float)
+            weight = bm25.idf.get(term, 0.0) * tfs * (bm25.k1 + 1) / (tfs + norm[docs])
+            postings[term] = (docs, weight)
+        self.postings = postings
+
+    def _score_matrix(self, queries: list[str]):
+        if self.postings is None:
+            self._build_postings()
+        postings = self.postings
+
+        scores = np.zeros((len(queries), len(self.keys)))
+        for row, query in enumerate(queries):
+            for token in self._tokenize(query):
+                posting = postings.get(token)
+                if posting is not None:
+                    scores[row, posting[0]] += posting[1]
+        return scores
+
+    def lookup(self, scores, keys: list):
+        # scores of specific candidates from a search_with_scores() result,
+        # 0 for keys not in the index
+        if scores is None:
+            return np.zeros(len(keys))
+        rows = np.array([self.positions.get(k, -1) for k in keys], dtype=int)
+        return np.where(rows >= 0, np.asarray(scores)[rows], 0.0)
+
+    def search_batch(self, queries: list[str], top_k: int):
+        return self.search_batch_with_scores(queries, top_k)[0]
+
+    def search_batch_with_scores(self, queries: list[str], top_k: int):
+        # one row of corpus scores per query, see search_with_scores()
+        if not self.bm25:
+            return [[] for _ in queries], [None for _ in queries]
+
+        scores = self._score_matrix(queries)
+
+        # stable sort keeps ties in corpus order, like search()
+        ranked = np.argsort(-scores, axis=1, kind="stable")[:, :top_k]
+        return [[self.keys[i] for i in row] for row in ranked], list(scores)
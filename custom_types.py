@@ -14,4 +14,23 @@ class RAGSearchResult(pydantic.BaseModel):
 class RAGQueryResult(pydantic.BaseModel):
     answer: str
     sources: list[str]
-    num_contexts: int
\ No newline at end of file
+    num_contexts: int
+
+class RetrievalConfig(pydantic.BaseModel):
+    vector_k: int | None = None      # None -> max(top_k * 4, 20)
+    dense_weight: float = 1.0        # 1.0 keeps vector hits ahead of BM25 hits
+    rerank_depth: int | None = None  # None -> rerank the whole pool, 0 -> skip reranker
+    prune_k: int | None = None       # cheap lexical/dense stage keeps this many, None -> off
+    early_exit_margin: float | None = None  # cross-encoder stops early, None -> score all
+    rerank_step: int = 8             # cross-encoder slice size when early exit is on
+
+class RAGBatchQuestion(pydantic.BaseModel):
+    question: str
+    source_id: str | None = None  # falls back to RAGBatchQuery.source_id
+    id: str | None = None
+
+class RAGBatchQuery(pydantic.BaseModel):
+    questions: list[RAGBatchQuestion]
+    source_id: str | None = None
+    top_k: int = 5
+    concurrency: int = 8          # answers generated in parallel
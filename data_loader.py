@@ -1,28 +1,57 @@
-from openai import OpenAI
-from llama_index.readers.file import PDFReader
-from llama_index.core.node_parser import SentenceSplitter
 from dotenv import load_dotenv
+from startup import lazy_import
 
 load_dotenv()
 
-client = OpenAI()
-
 EMBED_MODEL = "text-embedding-3-small"
 EMBED_DIM = 3072
+# OpenAI rejects embedding requests with more inputs than this
+EMBED_MAX_INPUTS = 2048
+
+# heavy clients are built on first use, not at import time
+_client = None
+_async_client = None
+_splitter = None
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = lazy_import("openai").OpenAI()
+    return _client
+
+
+def get_async_client():
+    global _async_client
+    if _async_client is None:
+        _async_client = lazy_import("openai").AsyncOpenAI()
+    return _async_client
+
+
+def get_splitter():
+    global _splitter
+    if _splitter is None:
+        node_parser = lazy_import("llama_index.core.node_parser")
+        _splitter = node_parser.SentenceSplitter(chunk_size=1000, chunk_overlap=200)
+    return _splitter
 
-splitter = SentenceSplitter(chunk_size=1000, chunk_overlap=200)
 
 def load_and_chunk_pdf(path:str):
+    PDFReader = lazy_import("llama_index.readers.file").PDFReader
     docs = PDFReader().load_data(file=path)
     texts = [d.text for d in docs if getattr(d, "text", None)]
     chunks = []
+    splitter = get_splitter()
     for t in texts:
         chunks.extend(splitter.split_text(t))
     return chunks
 
 def embed_texts(texts: list[str]) -> list[list[float]]:
-    response = client.embeddings.create(
-        model=EMBED_MODEL,
-        input=texts,
-    )
-    return [item.embedding for item in response.data]
\ No newline at end of file
+    vectors = []
+    for start in range(0, len(texts), EMBED_MAX_INPUTS):
+        response = get_client().embeddings.create(
+            model=EMBED_MODEL,
+            input=texts[start:start + EMBED_MAX_INPUTS],
+        )
+        vectors.extend(item.embedding for item in response.data)
+    return vectors
@@ -0,0 +1,149 @@
+import hashlib
+import mmap
+import os
+import shutil
+import threading
+from array import array
+
+# Optional local chunk store. When enabled at ingest, chunk text lives in an
+# append-only segment file next to the server and Qdrant payloads only carry
+# the chunk index; retrieval resolves text from a read-only memory map, so the
+# OS page cache holds one copy shared by every worker process.
+DOCSTORE_ENABLED = os.getenv("RAG_DOCSTORE", "0") == "1"
+DOCSTORE_DIR = os.getenv("RAG_DOCSTORE_DIR", "docstore")
+
+SEGMENT_FILE = "segment.bin"
+INDEX_FILE = "index.bin"
+DIGEST_FILE = "digest"
+
+
+def chunks_digest(chunks: list[str]) -> str:
+    h = hashlib.sha256()
+    for c in chunks:
+        data = c.encode("utf-8")
+        h.update(len(data).to_bytes(8, "little"))
+        h.update(data)
+    return h.hexdigest()
+
+
+class DocStore:
+
+    def __init__(self, collection: str, root: str = DOCSTORE_DIR):
+        self.path = os.path.join(root, collection)
+        self.segment_path = os.path.join(self.path, SEGMENT_FILE)
+        self.index_path = os.path.join(self.path, INDEX_FILE)
+        self.digest_path = os.path.join(self.path, DIGEST_FILE)
+        self._mm = None
+        # cached pipelines share one DocStore across the query worker threads
+        self._mm_lock = threading.Lock()
+        self._load_index()
+
+    @classmethod
+    def open(cls, collection: str, root: str = DOCSTORE_DIR):
+        # None when the collection was ingested without a docstore
+        if not os.path.exists(os.path.join(root, collection, INDEX_FILE)):
+            return None
+        return cls(collection, root)
+
+    def _load_index(self):
+        # flat (offset, length) pairs, one per chunk
+        self.index = array("Q")
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as f:
+                self.index.frombytes(f.read())
+        self._close_map()
+
+    def __len__(self):
+        return len(self.index) // 2
+
+    def append(self, texts: list[str]) -> list[int]:
+        os.makedirs(self.path, exist_ok=True)
+        start = len(self)
+        entries = array("Q")
+
+        with open(self.segment_path, "ab") as f:
+            offset = f.tell()
+            for t in texts:
+                data = t.encode("utf-8")
+                f.write(data)
+                entries.extend((offset, len(data)))
+                offset += len(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+        # index written after the data so it never points past the segment
+        with open(self.index_path, "ab") as f:
+            f.write(entries.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.index.extend(entries)
+        self._close_map()
+        return list(range(start, start + len(texts)))
+
+    def _stored_digest(self):
+        return self.read_digest(self.path)
+
+    @staticmethod
+    def read_digest(path: str):
+        # digest of the chunks last written to the docstore at `path`
+        digest_path = os.path.join(path, DIGEST_FILE)
+        if not os.path.exists(digest_path):
+            return None
+        with open(digest_path) as f:
+            return f.read().strip()
+
+    @staticmethod
+    def collection_digest(collection: str, root: str = DOCSTORE_DIR):
+        return DocStore.read_digest(os.path.join(root, collection))
+
+    def write_chunks(self, chunks: list[str]) -> list[int]:
+        # idempotent for Inngest step retries: keep the segment only if it
+        # holds exactly these chunks, otherwise rewrite it
+        digest = chunks_digest(chunks)
+        if len(self) == len(chunks) and self._stored_digest() == digest:
+            return list(range(len(chunks)))
+        self.reset()
+        ids = self.append(chunks)
+        with open(self.digest_path, "w") as f:
+            f.write(digest)
+        return ids
+
+    def _map(self):
+        if self._mm is None:
+            with self._mm_lock:
+                if self._mm is None and os.path.getsize(self.segment_path) > 0:
+                    with open(self.segment_path, "rb") as f:
+                        self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mm
+
+    def _close_map(self):
+        with self._mm_lock:
+            if self._mm is not None:
+                self._mm.close()
+                self._mm = None
+
+    def get(self, chunks: list[int]) -> list[str]:
+        mm = self._map()
+        if mm is None:
+            return ["" for _ in chunks]
+        texts = []
+        with memoryview(mm) as view:
+            for i in chunks:
+                offset, length = self.index[2 * i], self.index[2 * i + 1]
+                # decode straight from the mapped pages, no intermediate bytes copy
+                texts.append(str(view[offset:offset + length], "utf-8"))
+        return texts
+
+    def iter_texts(self):
+        for i in range(len(self)):
+            yield self.get([i])[0]
+
+    def reset(self):
+        self._close_map()
+        shutil.rmtree(self.path, ignore_errors=True)
+        self._load_index()
+
+    @staticmethod
+    def delete_collection(collection: str, root: str = DOCSTORE_DIR):
+        shutil.rmtree(os.path.join(root, collection), ignore_errors=True)
@@ -4,26 +4,35 @@
 #stop docker: docker stop qdrantRagDB
 
 import logging
+import json
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse, StreamingResponse
 import inngest
 import inngest.fast_api
 from inngest.experimental import ai
 from dotenv import load_dotenv
-import uuid
 import os
 import datetime
+from contextlib import aclosing
 from data_loader import load_and_chunk_pdf, embed_texts
-from vector_db import QdrantStorage
-from custom_types import RAGChunkAndSrc, RAGQueryResult, RAGSearchResult, RAGUpsertResult
+from vector_db import QdrantStorage, chunk_id
+from docstore import DocStore, DOCSTORE_ENABLED
+from custom_types import RAGChunkAndSrc, RAGQueryResult, RAGSearchResult, RAGUpsertResult, RAGBatchQuery
 from reranker import Reranker
-from retrieval_pipeline import RetrievalPipeline
-from query_engine import QueryEngine
+from retrieval_pipeline import RetrievalPipeline, evict_pipelines
+from query_engine import QueryEngine, answer_messages, ANSWER_MODEL
+from startup import lifespan, readiness
+from batch_query import run_batch
+from scheduler import scheduler, Overloaded, StageSaturated
 
 
 
 
 load_dotenv()
 
+# backoff Inngest applies to a query invocation shed by admission control
+SHED_RETRY_AFTER_S = float(os.getenv("RAG_SHED_RETRY_AFTER_S", 2))
+
 inngest_client = inngest.Inngest(
     app_id="rag_app",
     logger=logging.getLogger("uvicorn"),
@@ -67,9 +76,20 @@ async def rag_ingest_pdf(ctx: inngest.Context):
         chunks = chunks_and_src.chunks
         source_id = chunks_and_src.source_id
         vecs = embed_texts(chunks)
-        ids = [str(uuid.uuid5(uuid.NAMESPACE_URL, f"{source_id}:{i}")) for i in range(len(chunks))]
-        payloads = [{"source": source_id, "text": chunks[i]} for i in range(len(chunks)) ]
-        QdrantStorage().upsert(ids, vecs, payloads)
+        ids = [chunk_id(source_id, i) for i in range(len(chunks))]
+        if DOCSTORE_ENABLED:
+            # text goes to the local docstore, Qdrant only keeps the chunk index
+            DocStore(store.collection).write_chunks(chunks)
+            payloads = [
+                {"source": source_id, "chunk": i, "docstore": True}
+                for i in range(len(chunks))
+            ]
+        else:
+            # a leftover docstore from an earlier ingest must not be picked up
+            DocStore.delete_collection(store.collection)
+            payloads = [{"source": source_id, "text": chunks[i]} for i in range(len(chunks)) ]
+        store.upsert(ids, vecs, payloads)
+        evict_pipelines([store.collection])
         return RAGUpsertResult(ingested=len(chunks))
 
     chunks_and_src = await ctx.step.run("load-and-chunk", lambda: _load(ctx), output_type=RAGChunkAndSrc)
@@ -84,12 +104,18 @@ async def rag_ingest_pdf(ctx: inngest.Context):
     logging.info("Ingestion completed.")
 
     # ✅ cleanup policy (keep DB small)
-    store.delete_old_collections(keep_last=10)
+    deleted = store.delete_old_collections(keep_last=10)
+    for collection in deleted:
+        DocStore.delete_collection(collection)
+    evict_pipelines(deleted)
     return ingested.model_dump()
 
 @inngest_client.create_function(
     fn_id="RAG: Query PDF",
-    trigger=inngest.TriggerEvent(event="rag/query_pdf_ai")
+    trigger=inngest.TriggerEvent(event="rag/query_pdf_ai"),
+    # the LLM steps (rewrite, multi-hop check, answer) run on the Inngest
+    # server, so their concurrency is bounded here rather than in-process
+    concurrency=[inngest.Concurrency(limit=int(os.getenv("RAG_QUERY_CONCURRENCY", 8)))],
 )
 # async def rag_query_pdf_ai(ctx: inngest.Context):
 #     def _search(question: str, top_k: int = 5) -> RAGSearchResult:
@@ -154,11 +180,29 @@ async def rag_ingest_pdf(ctx: inngest.Context):
 
 async def rag_query_pdf_ai(ctx: inngest.Context):
 
+    # bounded queue + deadline: shed under burst instead of slowing everyone.
+    # Inngest re-invokes the function for every step, so admission and the
+    # deadline apply per invocation, not to the query end to end
+    try:
+        async with scheduler.admit():
+            return await _query_pdf(ctx)
+    except (Overloaded, StageSaturated) as e:
+        # retriable, so Inngest backs off and re-runs only the unfinished
+        # steps; a returned "busy" answer would be recorded as the result
+        logging.warning(f"Query shed: {e}")
+        raise inngest.RetryAfterError(
+            f"Query shed: {e}",
+            datetime.timedelta(seconds=SHED_RETRY_AFTER_S),
+        ) from e
+
+
+async def _query_pdf(ctx: inngest.Context):
+
     question = ctx.event.data["question"]
     top_k = int(ctx.event.data.get("top_k", 5))
 
     source_id = ctx.event.data["source_id"]
-    engine = QueryEngine(source_id)
+    engine = await scheduler.run_blocking(QueryEngine, source_id)
 
     contexts, sources, trace = await engine.retrieve_contexts(
         ctx,
@@ -173,18 +217,9 @@ async def rag_query_pdf_ai(ctx: inngest.Context):
         }
     logging.info(f"Retrieved {len(contexts)} contexts")
 
-    context_block = "\n\n".join(f"- {c}" for c in contexts)
-
-    user_content = (
-        "Use the following context to answer the question.\n\n"
-        f"Context:\n{context_block}\n\n"
-        f"Question: {question}\n"
-        "Answer concisely using the context above"
-    )
-
     adapter = ai.openai.Adapter(
         auth_key=os.getenv("OPENAI_API_KEY"),
-        model="gpt-5-nano"
+        model=ANSWER_MODEL
     )
 
     res = await ctx.step.ai.infer(
@@ -192,13 +227,7 @@ async def rag_query_pdf_ai(ctx: inngest.Context):
         adapter=adapter,
         body={
             "max_completion_tokens": 1024,
-            "messages": [
-                {
-                    "role": "system",
-                    "content": "You answer questions using only the provided context"
-                },
-                {"role": "user", "content": user_content},
-            ]
+            "messages": answer_messages(question, contexts),
         }
     )
 
@@ -211,6 +240,49 @@ async def rag_query_pdf_ai(ctx: inngest.Context):
     }
 
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+
+@app.get("/health/live")
+async def health_live():
+    return {"status": "ok"}
+
+
+@app.get("/health/ready")
+async def health_ready():
+    # 503 until the cross-encoder is loaded and warmed up; failed loads are retried
+    status = readiness()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+
+@app.get("/metrics/scheduler")
+async def scheduler_metrics():
+    # queue depth, shed counts and per-stage slot usage
+    return scheduler.metrics()
+
+
+@app.post("/query/batch")
+async def query_batch(batch: RAGBatchQuery):
+    # reject early when the batch slots are taken; the slot itself is taken
+    # inside stream() so it is only held by a generator that is actually running
+    if not scheduler.has_batch_capacity():
+        return JSONResponse({"error": "batch limit reached"}, status_code=503, headers={"Retry-After": "60"})
+
+    # one batch slot (separate from interactive admission) for the whole
+    # batch, held while it streams; one JSON line per question as soon as
+    # its answer is ready
+    async def stream():
+        if not scheduler.admit_batch():
+            yield json.dumps({"error": "batch limit reached"}) + "\n"
+            return
+        try:
+            async with aclosing(run_batch(batch)) as results:
+                async for result in results:
+                    yield json.dumps(result) + "\n"
+        finally:
+            scheduler.release_batch()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
 
 inngest.fast_api.serve(app, inngest_client, [rag_ingest_pdf, rag_query_pdf_ai])
\ No newline at end of file
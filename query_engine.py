@@ -1,15 +1,36 @@
 import os
 from inngest.experimental import ai
-from retrieval_pipeline import RetrievalPipeline
+from retrieval_pipeline import get_pipeline
 from rag_trace import RAGTrace
+from scheduler import scheduler
+
+ANSWER_MODEL = "gpt-5-nano"
+ANSWER_SYSTEM_PROMPT = "You answer questions using only the provided context"
+
+
+def answer_messages(question: str, contexts: list[str]):
+    context_block = "\n\n".join(f"- {c}" for c in contexts)
+
+    user_content = (
+        "Use the following context to answer the question.\n\n"
+        f"Context:\n{context_block}\n\n"
+        f"Question: {question}\n"
+        "Answer concisely using the context above"
+    )
+
+    return [
+        {"role": "system", "content": ANSWER_SYSTEM_PROMPT},
+        {"role": "user", "content": user_content},
+    ]
+
 
 class QueryEngine:
     def __init__(self, source_id):
-        self.pipeline = RetrievalPipeline(source_id)
+        self.pipeline = get_pipeline(source_id)
         self.trace = RAGTrace()
         self.adapter = ai.openai.Adapter(
             auth_key=os.getenv("OPENAI_API_KEY"),
-            model="gpt-5-nano"
+            model=ANSWER_MODEL
         )
 
     async def rewrite_query(self, ctx, question: str):
@@ -67,25 +88,6 @@ Reply ONLY with YES or NO.
         
         return answer.startswith("NO")
     
-    def rerank(self, question, contexts):
-
-        scored = []
-
-        for c in contexts:
-            score = len(set(question.lower().split())
-                        & set(c.lower().split()))
-            scored.append((score, c))
-
-        scored.sort(reverse=True)
-        reranked = [c for _, c in scored]
-
-        self.trace.log(
-            "Reranking",
-            {"before": len(contexts), "after": len(reranked)}
-        )
-
-        return reranked
-
     async def retrieve_contexts(self, ctx, question:str, top_k:int):
         
         #original query
@@ -95,12 +97,17 @@ Reply ONLY with YES or NO.
         rewritten = await self.rewrite_query(ctx, question)
         self.trace.log("Rewritten Query", {"rewritten": rewritten})
 
-        contexts, sources, stats = self.pipeline.retrieve(
-            rewritten, top_k
+        timings, counts = {}, {}
+        contexts, sources, mode = await scheduler.run_blocking(
+            self.pipeline.retrieve, rewritten, top_k, timings=timings, counts=counts
         )
 
-        self.trace.log("Hybrid Retrieval", stats)
-        contexts = self.rerank(question, contexts)
+        # ordering comes from the rerank cascade inside the pipeline
+        self.trace.log("Hybrid Retrieval", {
+            "mode": mode,
+            "counts": counts,
+            "timings_ms": {k: round(v, 1) for k, v in timings.items()},
+        })
 
         # multi-hop decision
         do_second = await self.needs_second_hop(
@@ -110,7 +117,8 @@ Reply ONLY with YES or NO.
 
         if do_second:
             followup_query = f"{question} detailed explanation"
-            more_contexts, _, _ = self.pipeline.retrieve(
+            more_contexts, _, _ = await scheduler.run_blocking(
+                self.pipeline.retrieve,
                 followup_query,
                 top_k
             )
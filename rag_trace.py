@@ -1,3 +1,7 @@
+import time
+from contextlib import contextmanager
+
+
 class RAGTrace:
     def __init__(self):
         self.steps = []
@@ -9,4 +13,15 @@ class RAGTrace:
         })
 
     def export(self):
-        return self.steps
\ No newline at end of file
+        return self.steps
+
+
+@contextmanager
+def timed(timings: dict, stage: str):
+    # accumulate wall time (ms) of a pipeline stage into `timings`
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = (time.perf_counter() - start) * 1000
+        timings[stage] = timings.get(stage, 0.0) + elapsed
@@ -1,11 +1,47 @@
-from sentence_transformers import CrossEncoder
+import threading
+from startup import lazy_import
+
+MODEL_NAME = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+# one cross-encoder per process, shared by every Reranker
+_model = None
+_model_error = None
+_model_lock = threading.Lock()
+
+
+def get_model(retry: bool = False):
+    # retry=True is for the warm-up task, which retries a failed load with backoff
+    global _model, _model_error
+    if _model is None:
+        with _model_lock:
+            if retry:
+                _model_error = None
+            # a failed load is cached so requests don't retry the download
+            if _model_error is not None:
+                raise RuntimeError(f"cross-encoder unavailable: {_model_error}")
+            if _model is None:
+                try:
+                    CrossEncoder = lazy_import("sentence_transformers").CrossEncoder
+                    _model = CrossEncoder(MODEL_NAME)
+                except Exception as e:
+                    _model_error = e
+                    raise
+    return _model
+
+
+def model_loaded() -> bool:
+    return _model is not None
+
 
 class Reranker:
     def __init__(self):
         # Cross-encoder evaluates (query, chunk) pairs
-        self.model = CrossEncoder(
-            "cross-encoder/ms-marco-MiniLM-L-6-v2"
-        )
+        self.model = get_model()
+
+    def warm_up(self, batch_size: int = 8):
+        # first predict pays for kernel init / allocation, do it before traffic
+        pairs = [("warm up query", "warm up passage " * 32)] * batch_size
+        self.model.predict(pairs)
 
     def rerank(self, query: str, contexts: list[str], top_k: int):
         pairs = [(query, c) for c in contexts]
@@ -20,3 +56,59 @@ class Reranker:
 
         reranked_contexts = [c for c, _ in ranked[:top_k]]
         return reranked_contexts
+
+    def rerank_batch(self, queries: list[str], contexts_per_query: list[list[str]],
+                     top_k: int, batch_size: int = 64):
+        # all (query, chunk) pairs share cross-encoder batches
+        pairs = [
+            (q, c)
+            for q, contexts in zip(queries, contexts_per_query)
+            for c in contexts
+        ]
+        scores = self.model.predict(pairs, batch_size=batch_size) if pairs else []
+
+        results = []
+        start = 0
+        for contexts in contexts_per_query:
+            ranked = sorted(
+                zip(contexts, scores[start:start + len(contexts)]),
+                key=lambda x: x[1],
+                reverse=True,
+            )
+            results.append([c for c, _ in ranked[:top_k]])
+            start += len(contexts)
+        return results
+
+    def rerank_cascade(self, query: str, contexts: list[str], top_k: int,
+                       step: int = 8, margin: float | None = None):
+        # Scores `contexts` (best cheap-stage candidates first) in slices and
+        # stops once a whole slice lands `margin` below the current top_k-th
+        # score: deeper, cheaper-ranked candidates are unlikely to beat it.
+        # Returns the top_k contexts and how many pairs were scored.
+        if margin is None:
+            step = len(contexts)
+        step = max(step, 1)
+
+        scores = []
+        size = max(step, top_k)
+        while len(scores) < len(contexts):
+            batch = contexts[len(scores):len(scores) + size]
+            batch_scores = list(self.model.predict([(query, c) for c in batch]))
+            scores += batch_scores
+            size = step
+
+            if margin is not None and len(scores) > len(batch_scores) and len(scores) >= top_k:
+                kth = sorted(scores, reverse=True)[top_k - 1]
+                if kth - max(batch_scores) >= margin:
+                    break
+
+        scored = len(scores)
+        ranked = sorted(
+            zip(contexts[:scored], scores),
+            key=lambda x: x[1],
+            reverse=True,
+        )
+        best = [c for c, _ in ranked[:top_k]]
+        # fewer than top_k scored: fill in cheap-stage order
+        best += contexts[scored:][:top_k - len(best)]
+        return best, scored
@@ -0,0 +1,268 @@
+#run sweep: uv run python retrieval_eval.py labels.json --write-config
+#
+# labels.json holds one entry per document, relevant chunks are chunk indices
+# as assigned at ingest time:
+# [
+#   {"source_id": "manual.pdf",
+#    "questions": [{"question": "How do I reset the device?", "relevant_chunks": [3, 4]}]}
+# ]
+
+import argparse
+import itertools
+import json
+import logging
+import math
+import os
+from data_loader import embed_texts
+from custom_types import RetrievalConfig
+from retrieval_pipeline import RetrievalPipeline, config_path, CONFIG_DIR
+from rag_trace import timed
+
+logger = logging.getLogger("rag")
+
+STAGES = ["embed", "vector", "bm25", "prune", "rerank"]
+
+
+# ---------- metrics ----------
+
+def recall_at_k(ranked: list[str], relevant: set[str], k: int) -> float:
+    if not relevant:
+        return 0.0
+    return len(set(ranked[:k]) & relevant) / len(relevant)
+
+
+def mrr_at_k(ranked: list[str], relevant: set[str], k: int) -> float:
+    for rank, c in enumerate(ranked[:k], start=1):
+        if c in relevant:
+            return 1.0 / rank
+    return 0.0
+
+
+def ndcg_at_k(ranked: list[str], relevant: set[str], k: int) -> float:
+    dcg = sum(
+        1.0 / math.log2(rank + 1)
+        for rank, c in enumerate(ranked[:k], start=1)
+        if c in relevant
+    )
+    ideal = sum(1.0 / math.log2(rank + 1) for rank in range(1, min(len(relevant), k) + 1))
+    return dcg / ideal if ideal else 0.0
+
+
+def _percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1)
+    return ordered[max(idx, 0)]
+
+
+def _mean(values: list[float]) -> float:
+    return sum(values) / len(values) if values else 0.0
+
+
+# ---------- sweep ----------
+
+def config_grid(vector_ks, dense_weights, rerank_depths, prune_ks=(None,), margins=(None,)):
+    grid = []
+    for vk, w, d, p, m in itertools.product(vector_ks, dense_weights, rerank_depths, prune_ks, margins):
+        # a rerank pool deeper than what can be merged is the same as "all"
+        if d is not None and d > 2 * vk:
+            continue
+        # without a reranker the cascade settings change nothing
+        if d == 0 and (p is not None or m is not None):
+            continue
+        grid.append(RetrievalConfig(
+            vector_k=vk, dense_weight=w, rerank_depth=d, prune_k=p, early_exit_margin=m
+        ))
+    return grid
+
+
+def evaluate_document(doc: dict, configs: list[RetrievalConfig], top_k: int):
+    source_id = doc["source_id"]
+    questions = doc["questions"]
+    pipeline = RetrievalPipeline(source_id, config=RetrievalConfig())
+
+    relevant_sets = []
+    for q in questions:
+        texts = pipeline.chunk_texts(q["relevant_chunks"])
+        missing = [i for i, t in zip(q["relevant_chunks"], texts) if not t]
+        if missing:
+            logger.warning(f"{source_id}: chunks {missing} not found in Qdrant")
+        relevant_sets.append({t for t in texts if t})
+
+    # query embedding does not depend on the config, embed once per question
+    embed_timings = {}
+    with timed(embed_timings, "embed"):
+        query_vecs = embed_texts([q["question"] for q in questions])
+    embed_ms = embed_timings["embed"] / max(len(questions), 1)
+
+    # untimed pass: the first timed config must not pay for the cross-encoder's
+    # first predict or a cold Qdrant connection
+    if pipeline.reranker_available:
+        pipeline.reranker.warm_up()
+    if questions:
+        pipeline.retrieve_with_vector(questions[0]["question"], query_vecs[0], top_k)
+
+    results = []
+    for config in configs:
+        recalls, mrrs, ndcgs = [], [], []
+        stage_ms = {s: [] for s in STAGES}
+        totals = []
+        reranked = []
+        for q, vec, relevant in zip(questions, query_vecs, relevant_sets):
+            timings = {"embed": embed_ms}
+            counts = {}
+            ranked, _, _ = pipeline.retrieve_with_vector(
+                q["question"], vec, top_k, config, timings, counts
+            )
+            reranked.append(counts.get("reranked", 0))
+            recalls.append(recall_at_k(ranked, relevant, top_k))
+            mrrs.append(mrr_at_k(ranked, relevant, top_k))
+            ndcgs.append(ndcg_at_k(ranked, relevant, top_k))
+            for s in STAGES:
+                stage_ms[s].append(timings.get(s, 0.0))
+            totals.append(sum(timings.values()))
+
+        results.append({
+            "config": config.model_dump(),
+            "recall": _mean(recalls),
+            "mrr": _mean(mrrs),
+            "ndcg": _mean(ndcgs),
+            "reranked_pairs": _mean(reranked),
+            "latency_ms": {
+                **{s: _mean(v) for s, v in stage_ms.items()},
+                "total": _mean(totals),
+                "total_p95": _percentile(totals, 95),
+            },
+        })
+
+    return pipeline.store.collection, results
+
+
+def pareto_front(results: list[dict], metric: str) -> list[dict]:
+    # non-dominated configs: no other config is both better and faster
+    front = []
+    for r in results:
+        dominated = any(
+            o[metric] >= r[metric]
+            and o["latency_ms"]["total"] <= r["latency_ms"]["total"]
+            and (o[metric] > r[metric] or o["latency_ms"]["total"] < r["latency_ms"]["total"])
+            for o in results
+        )
+        if not dominated:
+            front.append(r)
+    return sorted(front, key=lambda r: r["latency_ms"]["total"])
+
+
+def recommend(front: list[dict], metric: str, tolerance: float) -> dict:
+    # cheapest frontier config within `tolerance` of the best quality
+    best = max(r[metric] for r in front)
+    for r in front:
+        if r[metric] >= best - tolerance:
+            return r
+    return front[-1]
+
+
+def print_report(collection: str, results: list[dict], front: list[dict], chosen: dict):
+    print(f"\n=== {collection} ({len(results)} configs)")
+    header = f"{'vector_k':>8} {'dense_w':>7} {'rerank':>6} {'prune':>5} {'margin':>6}"
+    header += f" {'recall':>7} {'mrr':>6} {'ndcg':>6} {'pairs':>6}"
+    header += "".join(f" {s + '_ms':>10}" for s in STAGES) + f" {'total_ms':>9} {'p95_ms':>8}"
+    print(header)
+    for r in sorted(results, key=lambda r: r["latency_ms"]["total"]):
+        cfg = r["config"]
+        depth = "all" if cfg["rerank_depth"] is None else cfg["rerank_depth"]
+        mark = "*" if r is chosen else ("p" if r in front else " ")
+        prune = "-" if cfg["prune_k"] is None else cfg["prune_k"]
+        margin = "-" if cfg["early_exit_margin"] is None else cfg["early_exit_margin"]
+        line = f"{cfg['vector_k']:>8} {cfg['dense_weight']:>7.2f} {depth:>6} {prune:>5} {margin:>6} "
+        line += f"{r['recall']:>7.3f} {r['mrr']:>6.3f} {r['ndcg']:>6.3f} {r['reranked_pairs']:>6.1f}"
+        line += "".join(f" {r['latency_ms'][s]:>10.1f}" for s in STAGES)
+        line += f" {r['latency_ms']['total']:>9.1f} {r['latency_ms']['total_p95']:>8.1f} {mark}"
+        print(line)
+    print("p = Pareto-optimal, * = recommended")
+
+
+def _int_list(value: str):
+    return [int(v) for v in value.split(",")]
+
+
+def _float_list(value: str):
+    return [float(v) for v in value.split(",")]
+
+
+def _depth_list(value: str):
+    return [None if v == "all" else int(v) for v in value.split(",")]
+
+
+def _optional_int_list(value: str):
+    return [None if v == "none" else int(v) for v in value.split(",")]
+
+
+def _optional_float_list(value: str):
+    return [None if v == "none" else float(v) for v in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep retrieval settings against labelled questions")
+    parser.add_argument("labels", help="JSON file with labelled questions per source_id")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--vector-k", type=_int_list, default=[10, 20, 40, 80])
+    parser.add_argument("--dense-weight", type=_float_list, default=[0.3, 0.5, 0.7, 1.0])
+    parser.add_argument("--rerank-depth", type=_depth_list, default=[0, 10, 20, 40, None],
+                        help="comma separated, 0 = no rerank, all = whole pool")
+    parser.add_argument("--prune-k", type=_optional_int_list, default=[None, 20],
+                        help="cheap-stage survivors before the cross-encoder, none = off")
+    parser.add_argument("--early-exit-margin", type=_optional_float_list, default=[None, 2.0],
+                        help="cross-encoder early-exit margin, none = score every survivor")
+    parser.add_argument("--metric", choices=["recall", "mrr", "ndcg"], default="ndcg")
+    parser.add_argument("--tolerance", type=float, default=0.01,
+                        help="quality loss accepted for a cheaper config")
+    parser.add_argument("--write-config", action="store_true",
+                        help=f"save the recommendation to {CONFIG_DIR}/<collection>.json")
+    parser.add_argument("--report", help="write the full sweep results to this JSON file")
+    args = parser.parse_args()
+
+    with open(args.labels) as f:
+        docs = json.load(f)
+    if isinstance(docs, dict):
+        docs = [docs]
+
+    configs = config_grid(
+        args.vector_k, args.dense_weight, args.rerank_depth,
+        args.prune_k, args.early_exit_margin,
+    )
+    report = {}
+
+    for doc in docs:
+        collection, results = evaluate_document(doc, configs, args.top_k)
+        front = pareto_front(results, args.metric)
+        chosen = recommend(front, args.metric, args.tolerance)
+        print_report(collection, results, front, chosen)
+
+        report[collection] = {
+            "source_id": doc["source_id"],
+            "results": results,
+            "pareto": front,
+            "recommended": chosen,
+        }
+
+        if args.write_config:
+            os.makedirs(CONFIG_DIR, exist_ok=True)
+            with open(config_path(collection), "w") as f:
+                json.dump({
+                    "source_id": doc["source_id"],
+                    "config": chosen["config"],
+                    args.metric: chosen[args.metric],
+                    "latency_ms": chosen["latency_ms"],
+                }, f, indent=2)
+            print(f"Wrote {config_path(collection)}")
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main()
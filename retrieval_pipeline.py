@@ -1,16 +1,118 @@
+import json
 import logging
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
 from data_loader import embed_texts
-from vector_db import QdrantStorage
-from reranker import Reranker
+from vector_db import QdrantStorage, chunk_id
+from reranker import Reranker, model_loaded
 from bm25_index import BM25Index
+from custom_types import RetrievalConfig
+from rag_trace import timed
+from docstore import DocStore
+from scheduler import scheduler, StageSaturated
 
 logger = logging.getLogger("rag")
 
+# per-collection configs written by retrieval_eval.py
+CONFIG_DIR = os.getenv("RETRIEVAL_CONFIG_DIR", "retrieval_configs")
+
+RRF_K = 60
+
+# cheap-stage mix of dense similarity and BM25
+PRUNE_DENSE_WEIGHT = 0.5
+
+# (question, chunk) pairs scored per batch rerank slot; the slot is released
+# between chunks so concurrent batches take turns on the cross-encoder
+BATCH_RERANK_PAIRS = int(os.getenv("RAG_BATCH_RERANK_PAIRS", 512))
+
+# pipelines (BM25 index, docstore map) kept per process for the query path,
+# rebuilt when the document or its retrieval config changes on disk
+PIPELINE_CACHE_SIZE = int(os.getenv("RAG_PIPELINE_CACHE", 8))
+_pipelines = OrderedDict()
+_pipelines_lock = threading.Lock()
+
+
+def config_path(collection: str) -> str:
+    return os.path.join(CONFIG_DIR, f"{collection}.json")
+
+
+def load_retrieval_config(collection: str) -> RetrievalConfig:
+    path = config_path(collection)
+    if not os.path.exists(path):
+        return RetrievalConfig()
+    try:
+        with open(path) as f:
+            data = json.load(f)
+        return RetrievalConfig(**data.get("config", data))
+    except Exception as e:
+        logger.warning(f"Ignoring retrieval config {path}: {e}")
+        return RetrievalConfig()
+
+
+def fuse(vector_contexts: list, bm25_contexts: list, dense_weight: float):
+    # weighted reciprocal-rank fusion; ties keep vector-then-BM25 order
+    scores = {}
+    for rank, c in enumerate(vector_contexts):
+        scores[c] = scores.get(c, 0.0) + dense_weight / (RRF_K + rank)
+    for rank, c in enumerate(bm25_contexts):
+        scores[c] = scores.get(c, 0.0) + (1 - dense_weight) / (RRF_K + rank)
+    return sorted(scores, key=lambda c: scores[c], reverse=True)
+
+
+def _pair_chunks(pools: list, max_pairs: int):
+    # consecutive question ranges holding at most max_pairs candidates
+    # (at least one question each)
+    start, pairs = 0, 0
+    for i, pool in enumerate(pools):
+        if i > start and pairs + len(pool) > max_pairs:
+            yield start, i
+            start, pairs = i, 0
+        pairs += len(pool)
+    if start < len(pools):
+        yield start, len(pools)
+
+
+def source_fingerprint(store: QdrantStorage):
+    # what a pipeline is built from: checked on every cache hit, because
+    # another worker process may have re-ingested the document or rewritten
+    # its config since
+    path = config_path(store.collection)
+    config_mtime = os.path.getmtime(path) if os.path.exists(path) else None
+    return (
+        config_mtime,
+        store.count(),
+        DocStore.collection_digest(store.collection),
+    )
+
+
+def _minmax(values):
+    values = np.asarray(values, dtype=float)
+    if np.isnan(values).all():
+        return np.zeros(len(values))
+    # candidates without a score rank strictly below every scored one
+    low, high = np.nanmin(values), np.nanmax(values)
+    values = np.where(np.isnan(values), low - ((high - low) or 1.0), values)
+    span = values.max() - values.min()
+    return (values - values.min()) / span if span > 0 else np.zeros(len(values))
+
 
 class RetrievalPipeline:
 
-    def __init__(self, source_id: str):
+    def __init__(self, source_id: str, config: RetrievalConfig | None = None):
+        self.source_id = source_id
         self.store = QdrantStorage(source_id)
+        # taken before loading: a change during the build shows up as stale
+        self.fingerprint = source_fingerprint(self.store)
+        self.config = config or load_retrieval_config(self.store.collection)
+
+        # candidates are chunk ids when the document has a docstore, else texts
+        self.docstore = None
+        if self.store.uses_docstore():
+            self.docstore = DocStore.open(self.store.collection)
+            if self.docstore is None:
+                raise RuntimeError(f"Docstore missing for {self.store.collection}")
 
         # ---------- Load reranker ----------
         try:
@@ -23,48 +125,243 @@ class RetrievalPipeline:
 
         # ---------- Build BM25 ----------
         try:
-            contexts, sources = self.store.get_all_texts()
             self.bm25 = BM25Index()
-            self.bm25.build(contexts, sources)
+            if self.docstore is not None:
+                n = len(self.docstore)
+                self.bm25.build(
+                    self.docstore.iter_texts(), [source_id] * n, range(n)
+                )
+            else:
+                contexts, sources = self.store.get_all_texts()
+                self.bm25.build(contexts, sources)
             self.bm25_available = True
             logger.info("BM25 index ready")
         except Exception as e:
             logger.warning(f"BM25 unavailable: {e}")
             self.bm25_available = False
 
-    def retrieve(self, question: str, top_k: int = 5):
+    def is_current(self) -> bool:
+        # a cross-encoder that came up after this pipeline was built also
+        # makes it stale, otherwise it would never rerank
+        if not self.reranker_available and model_loaded():
+            return False
+        try:
+            return source_fingerprint(self.store) == self.fingerprint
+        except Exception as e:
+            logger.warning(f"Pipeline check for {self.store.collection} failed: {e}")
+            return False
+
+    def texts(self, keys: list) -> list[str]:
+        # resolve candidate keys to chunk text, only for chunks that need it
+        if self.docstore is not None:
+            return self.docstore.get(keys)
+        return list(keys)
+
+    def chunk_texts(self, chunks: list[int]) -> list[str | None]:
+        # text of chunks by their ingest index, None for unknown indices
+        if self.docstore is not None:
+            n = len(self.docstore)
+            return [
+                self.docstore.get([i])[0] if 0 <= i < n else None
+                for i in chunks
+            ]
+        return self.store.get_texts_by_ids(
+            [chunk_id(self.source_id, i) for i in chunks]
+        )
+
+    def prune(self, keys: list, vec_scores: dict, bm25_scores, n: int):
+        # cheap stage: vectorised dense similarity + BM25 over the pool,
+        # keeps the n best in descending order. bm25_scores are the corpus
+        # scores from the BM25 search, looked up rather than recomputed
+        dense = [vec_scores.get(k, np.nan) for k in keys]
+        lexical = np.zeros(len(keys))
+        if self.bm25_available:
+            lexical = self.bm25.lookup(bm25_scores, keys)
+
+        cheap = PRUNE_DENSE_WEIGHT * _minmax(dense) + (1 - PRUNE_DENSE_WEIGHT) * _minmax(lexical)
+        order = np.argsort(-cheap, kind="stable")[:n]
+        return [keys[i] for i in order]
+
+    def _rerank_pool(self, merged: list, vec_scores: dict, bm25_scores,
+                     config: RetrievalConfig, timings: dict, counts: dict):
+        pool = merged if config.rerank_depth is None else merged[:config.rerank_depth]
+        if config.prune_k is not None and len(pool) > config.prune_k:
+            with timed(timings, "prune"):
+                pool = self.prune(pool, vec_scores, bm25_scores, config.prune_k)
+        counts["pruned"] = len(pool)
+        return pool
+
+    def _pad(self, best: list[str], merged: list, pool: list, top_k: int):
+        # pool smaller than top_k: pad with the next fused candidates
+        if len(best) >= top_k:
+            return best
+        in_pool = set(pool)
+        rest = [k for k in merged if k not in in_pool]
+        return best + self.texts(rest[:top_k - len(best)])
+
+    def retrieve(self, question: str, top_k: int = 5,
+                 config: RetrievalConfig | None = None,
+                 timings: dict | None = None,
+                 counts: dict | None = None):
+
+        timings = {} if timings is None else timings
+        # timed inside the slot: stage latency excludes the wait for it
+        with scheduler.stage("embed"), timed(timings, "embed"):
+            query_vec = embed_texts([question])[0]
 
-        query_vec = embed_texts([question])[0]
+        return self.retrieve_with_vector(
+            question, query_vec, top_k, config, timings, counts
+        )
+
+    def retrieve_with_vector(self, question: str, query_vec, top_k: int = 5,
+                             config: RetrievalConfig | None = None,
+                             timings: dict | None = None,
+                             counts: dict | None = None):
+
+        config = config or self.config
+        timings = {} if timings is None else timings
+        counts = {} if counts is None else counts
 
         # -------- VECTOR SEARCH --------
-        vector_k = max(top_k * 4, 20)
-        vec_found = self.store.search(query_vec, vector_k)
-        vector_contexts = vec_found["contexts"]
+        vector_k = config.vector_k or max(top_k * 4, 20)
+        with scheduler.stage("qdrant"), timed(timings, "vector"):
+            vec_found = self.store.search(query_vec, vector_k)
+        vector_contexts = vec_found["keys"]
+        vec_scores = dict(zip(vec_found["keys"], vec_found["scores"]))
         sources = vec_found["sources"]
 
         # -------- BM25 SEARCH --------
-        bm25_contexts = []
+        bm25_contexts, bm25_scores = [], None
         if self.bm25_available:
-            bm25_contexts = self.bm25.search(question, vector_k)
+            with timed(timings, "bm25"):
+                bm25_contexts, bm25_scores = self.bm25.search_with_scores(question, vector_k)
 
         # -------- MERGE --------
-        merged = list(dict.fromkeys(vector_contexts + bm25_contexts))
+        merged = fuse(vector_contexts, bm25_contexts, config.dense_weight)
 
         logger.info(
             f"Vector:{len(vector_contexts)} BM25:{len(bm25_contexts)} merged:{len(merged)}"
         )
+        counts.update(
+            vector=len(vector_contexts), bm25=len(bm25_contexts), merged=len(merged)
+        )
 
-        # -------- RERANK --------
-        if self.reranker_available:
+        # -------- RERANK CASCADE --------
+        pool = self._rerank_pool(merged, vec_scores, bm25_scores, config, timings, counts)
+        if self.reranker_available and pool:
             try:
-                best = self.reranker.rerank(
-                    question,
-                    merged,
-                    top_k
-                )
-                return best, sources, "hybrid_rerank"
+                with scheduler.rerank_slot(), timed(timings, "rerank"):
+                    best, scored = self.reranker.rerank_cascade(
+                        question,
+                        self.texts(pool),
+                        top_k,
+                        config.rerank_step,
+                        config.early_exit_margin,
+                    )
+                counts["reranked"] = scored
+                counts["early_exit"] = scored < len(pool)
+                return self._pad(best, merged, pool, top_k), sources, "hybrid_rerank"
+            except StageSaturated:
+                logger.warning("Reranker saturated, degrading to hybrid_no_rerank")
+                scheduler.record_degraded_rerank()
+                counts["degraded"] = True
             except Exception as e:
                 logger.error(f"Rerank failed: {e}")
 
         # -------- FALLBACK --------
-        return merged[:top_k], sources, "hybrid_no_rerank"
+        return self.texts(merged[:top_k]), sources, "hybrid_no_rerank"
+
+    def retrieve_batch(self, questions: list[str], top_k: int = 5,
+                       config: RetrievalConfig | None = None):
+        # same stages as retrieve(), batched across questions: one embedding
+        # call, one Qdrant batch search, one BM25 pass, shared rerank batches
+        config = config or self.config
+        if not questions:
+            return []
+
+        with scheduler.stage("embed"):
+            query_vecs = embed_texts(questions)
+
+        # -------- VECTOR SEARCH --------
+        vector_k = config.vector_k or max(top_k * 4, 20)
+        with scheduler.stage("qdrant"):
+            vec_found = self.store.search_batch(query_vecs, vector_k)
+        vec_scores = [dict(zip(v["keys"], v["scores"])) for v in vec_found]
+
+        # -------- BM25 SEARCH --------
+        bm25_found, bm25_scores = [[] for _ in questions], [None for _ in questions]
+        if self.bm25_available:
+            bm25_found, bm25_scores = self.bm25.search_batch_with_scores(questions, vector_k)
+
+        # -------- MERGE --------
+        merged = [
+            fuse(v["keys"], b, config.dense_weight)
+            for v, b in zip(vec_found, bm25_found)
+        ]
+        sources = [v["sources"] for v in vec_found]
+
+        logger.info(
+            f"Batch of {len(questions)}: merged:{sum(len(m) for m in merged)}"
+        )
+
+        # -------- RERANK --------
+        # cheap prune per question; no early exit, pairs share full batches
+        pools = [
+            self._rerank_pool(m, vs, bs, config, {}, {})
+            for m, vs, bs in zip(merged, vec_scores, bm25_scores)
+        ]
+        if self.reranker_available and any(pools):
+            try:
+                best = []
+                for start, end in _pair_chunks(pools, BATCH_RERANK_PAIRS):
+                    # batch jobs wait for their own rerank slot instead of degrading
+                    with scheduler.stage("rerank_batch"):
+                        best += self.reranker.rerank_batch(
+                            questions[start:end],
+                            [self.texts(p) for p in pools[start:end]],
+                            top_k
+                        )
+                results = []
+                for b, m, p, s in zip(best, merged, pools, sources):
+                    b = self._pad(b, m, p, top_k)
+                    results.append((b, s, "hybrid_rerank" if p else "hybrid_no_rerank"))
+                return results
+            except Exception as e:
+                logger.error(f"Batch rerank failed: {e}")
+
+        # -------- FALLBACK --------
+        return [
+            (self.texts(m[:top_k]), s, "hybrid_no_rerank")
+            for m, s in zip(merged, sources)
+        ]
+
+
+def get_pipeline(source_id: str) -> RetrievalPipeline:
+    # reuse the pipeline of a document across queries instead of reloading
+    # its BM25 index on every request
+    with _pipelines_lock:
+        pipeline = _pipelines.get(source_id)
+
+    if pipeline is not None and pipeline.is_current():
+        with _pipelines_lock:
+            if source_id in _pipelines:
+                _pipelines.move_to_end(source_id)
+        return pipeline
+
+    pipeline = RetrievalPipeline(source_id)
+
+    with _pipelines_lock:
+        _pipelines[source_id] = pipeline
+        _pipelines.move_to_end(source_id)
+        while len(_pipelines) > PIPELINE_CACHE_SIZE:
+            _pipelines.popitem(last=False)
+    return pipeline
+
+
+def evict_pipelines(collections: list[str]):
+    # drop cached pipelines of re-ingested or deleted collections
+    collections = set(collections)
+    with _pipelines_lock:
+        stale = [s for s, p in _pipelines.items() if p.store.collection in collections]
+        for source_id in stale:
+            del _pipelines[source_id]
@@ -0,0 +1,314 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+
+logger = logging.getLogger("rag")
+
+# deadline (time.monotonic()) of the query running in this context
+_deadline = contextvars.ContextVar("rag_query_deadline", default=None)
+
+
+class Overloaded(Exception):
+    # query shed at admission: queue full or deadline passed while queued
+    pass
+
+
+class StageSaturated(Exception):
+    # no free slot for a stage before the deadline / allowed wait
+    pass
+
+
+def _expired() -> bool:
+    deadline = _deadline.get()
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def _remaining(max_wait: float | None = None):
+    # seconds left to wait for a slot, None = wait forever
+    waits = []
+    deadline = _deadline.get()
+    if deadline is not None:
+        waits.append(deadline - time.monotonic())
+    if max_wait is not None:
+        waits.append(max_wait)
+    return max(min(waits), 0.0) if waits else None
+
+
+async def _acquire(sem: asyncio.Semaphore, timeout: float | None) -> bool:
+    # asyncio.wait_for(sem.acquire()) can drop a permit that is granted just
+    # as the timeout fires (Python < 3.12); wait on a task instead and hand
+    # back a permit that arrives after we gave up
+    task = asyncio.ensure_future(sem.acquire())
+    try:
+        await asyncio.wait({task}, timeout=timeout)
+    except asyncio.CancelledError:
+        if task.done() and not task.cancelled():
+            sem.release()
+        else:
+            task.cancel()
+        raise
+    if task.done():
+        return True
+
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        return False
+    sem.release()
+    return False
+
+
+class Stage:
+    # concurrency limit for a blocking stage, used from worker threads
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self._sem = threading.BoundedSemaphore(limit)
+        self._lock = threading.Lock()
+        self.in_use = 0
+        self.waiting = 0
+        self.saturated = 0
+
+    @contextmanager
+    def slot(self, max_wait: float | None = None):
+        if _expired():
+            with self._lock:
+                self.saturated += 1
+            raise StageSaturated(f"deadline passed before {self.name} stage")
+
+        timeout = _remaining(max_wait)
+        with self._lock:
+            self.waiting += 1
+        try:
+            acquired = self._sem.acquire(timeout=timeout)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+        if not acquired:
+            with self._lock:
+                self.saturated += 1
+            raise StageSaturated(f"{self.name} stage saturated")
+
+        with self._lock:
+            self.in_use += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_use -= 1
+            self._sem.release()
+
+    def snapshot(self):
+        return {
+            "limit": self.limit,
+            "in_use": self.in_use,
+            "waiting": self.waiting,
+            "saturated": self.saturated,
+        }
+
+
+class AsyncStage:
+    # concurrency limit for an async stage (LLM calls), used on the event loop
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self._sem = asyncio.Semaphore(limit)
+        self.in_use = 0
+        self.waiting = 0
+        self.saturated = 0
+
+    @asynccontextmanager
+    async def slot(self, max_wait: float | None = None):
+        if _expired():
+            self.saturated += 1
+            raise StageSaturated(f"deadline passed before {self.name} stage")
+
+        self.waiting += 1
+        try:
+            acquired = await _acquire(self._sem, _remaining(max_wait))
+        finally:
+            self.waiting -= 1
+        if not acquired:
+            self.saturated += 1
+            raise StageSaturated(f"{self.name} stage saturated")
+
+        self.in_use += 1
+        try:
+            yield
+        finally:
+            self.in_use -= 1
+            self._sem.release()
+
+    def snapshot(self):
+        return {
+            "limit": self.limit,
+            "in_use": self.in_use,
+            "waiting": self.waiting,
+            "saturated": self.saturated,
+        }
+
+
+class QueryScheduler:
+
+    def __init__(self, max_concurrent: int = 8, max_queue: int = 32,
+                 deadline_s: float = 30.0, workers: int = 8,
+                 embed_limit: int = 8, qdrant_limit: int = 8,
+                 rerank_limit: int = 2, llm_limit: int = 16,
+                 rerank_wait_s: float = 0.1, max_batches: int = 2,
+                 batch_rerank_limit: int = 1):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.deadline_s = deadline_s
+        self.rerank_wait_s = rerank_wait_s
+
+        self._admission = asyncio.Semaphore(max_concurrent)
+        self.queued = 0
+        self.in_flight = 0
+        self.admitted = 0
+        self.shed_queue_full = 0
+        self.shed_deadline = 0
+        self.degraded_rerank = 0
+
+        # batch jobs run for minutes to hours: their own admission limit,
+        # never queued, so they cannot hold the interactive slots
+        self.max_batches = max_batches
+        self.batches_in_flight = 0
+        self.shed_batches = 0
+
+        # retrieval (BM25, cross-encoder, blocking HTTP) runs here, not on the loop
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rag-query")
+        self.stages = {
+            "embed": Stage("embed", embed_limit),
+            "qdrant": Stage("qdrant", qdrant_limit),
+            "rerank": Stage("rerank", rerank_limit),
+            # batch reranking has its own slots so it never starves interactive queries
+            "rerank_batch": Stage("rerank_batch", batch_rerank_limit),
+        }
+        self.llm = AsyncStage("llm", llm_limit)
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_concurrent=int(os.getenv("RAG_MAX_CONCURRENT_QUERIES", 8)),
+            max_queue=int(os.getenv("RAG_MAX_QUEUED_QUERIES", 32)),
+            deadline_s=float(os.getenv("RAG_QUERY_DEADLINE_S", 30)),
+            workers=int(os.getenv("RAG_QUERY_WORKERS", 8)),
+            embed_limit=int(os.getenv("RAG_EMBED_CONCURRENCY", 8)),
+            qdrant_limit=int(os.getenv("RAG_QDRANT_CONCURRENCY", 8)),
+            rerank_limit=int(os.getenv("RAG_RERANK_CONCURRENCY", 2)),
+            llm_limit=int(os.getenv("RAG_LLM_CONCURRENCY", 16)),
+            rerank_wait_s=float(os.getenv("RAG_RERANK_WAIT_S", 0.1)),
+            max_batches=int(os.getenv("RAG_MAX_CONCURRENT_BATCHES", 2)),
+            batch_rerank_limit=int(os.getenv("RAG_BATCH_RERANK_CONCURRENCY", 1)),
+        )
+
+    async def acquire(self, deadline_s: float | None = None) -> float:
+        # wait in the bounded queue for an admission slot, returns the deadline
+        deadline = time.monotonic() + (deadline_s or self.deadline_s)
+
+        # free slot: admit without queueing
+        if not self._admission.locked():
+            await self._admission.acquire()
+            self.admitted += 1
+            self.in_flight += 1
+            return deadline
+
+        if self.queued >= self.max_queue:
+            self.shed_queue_full += 1
+            raise Overloaded("query queue full")
+
+        self.queued += 1
+        try:
+            acquired = await _acquire(
+                self._admission, max(deadline - time.monotonic(), 0.0)
+            )
+        finally:
+            self.queued -= 1
+        if not acquired:
+            self.shed_deadline += 1
+            raise Overloaded("deadline passed while queued")
+
+        self.admitted += 1
+        self.in_flight += 1
+        return deadline
+
+    def release(self):
+        self.in_flight -= 1
+        self._admission.release()
+
+    @asynccontextmanager
+    async def admit(self, deadline_s: float | None = None):
+        # admission plus a deadline that also bounds every stage wait
+        deadline = await self.acquire(deadline_s)
+        token = _deadline.set(deadline)
+        try:
+            yield
+        finally:
+            _deadline.reset(token)
+            self.release()
+
+    def has_batch_capacity(self) -> bool:
+        return self.batches_in_flight < self.max_batches
+
+    def admit_batch(self) -> bool:
+        # non-blocking: False when max_batches are already running
+        if not self.has_batch_capacity():
+            self.shed_batches += 1
+            return False
+        self.batches_in_flight += 1
+        return True
+
+    def release_batch(self):
+        self.batches_in_flight -= 1
+
+    async def run_blocking(self, fn, *args, **kwargs):
+        # run on the bounded worker pool, carrying the deadline along
+        ctx = contextvars.copy_context()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.pool, functools.partial(ctx.run, fn, *args, **kwargs)
+        )
+
+    def stage(self, name: str, max_wait: float | None = None):
+        return self.stages[name].slot(max_wait)
+
+    def rerank_slot(self):
+        # short wait only: callers degrade to hybrid_no_rerank when saturated
+        return self.stages["rerank"].slot(self.rerank_wait_s)
+
+    def record_degraded_rerank(self):
+        self.degraded_rerank += 1
+
+    def llm_slot(self):
+        return self.llm.slot()
+
+    def metrics(self) -> dict:
+        return {
+            "queue_depth": self.queued,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "max_concurrent": self.max_concurrent,
+            "admitted": self.admitted,
+            "shed_queue_full": self.shed_queue_full,
+            "shed_deadline": self.shed_deadline,
+            "degraded_rerank": self.degraded_rerank,
+            "batches_in_flight": self.batches_in_flight,
+            "max_batches": self.max_batches,
+            "shed_batches": self.shed_batches,
+            "stages": {
+                **{name: s.snapshot() for name, s in self.stages.items()},
+                "llm": self.llm.snapshot(),
+            },
+        }
+
+
+scheduler = QueryScheduler.from_env()
@@ -0,0 +1,104 @@
+import asyncio
+import importlib
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger("rag")
+
+# module name -> import time (ms), filled as heavy modules are first needed
+IMPORT_TIMES = {}
+_import_lock = threading.Lock()
+
+# warm-up state reported by the readiness endpoint
+STATE = {
+    "ready": False,
+    "error": None,
+    "attempts": 0,
+    "warmup_ms": {},
+}
+
+# backoff between warm-up attempts, e.g. while the model download is failing
+WARMUP_RETRY_S = float(os.getenv("RAG_WARMUP_RETRY_S", 5))
+WARMUP_RETRY_MAX_S = float(os.getenv("RAG_WARMUP_RETRY_MAX_S", 300))
+
+
+def lazy_import(name: str):
+    # import a heavy module on first use and record how long it took
+    if name not in IMPORT_TIMES:
+        with _import_lock:
+            if name not in IMPORT_TIMES:
+                start = time.perf_counter()
+                importlib.import_module(name)
+                IMPORT_TIMES[name] = round((time.perf_counter() - start) * 1000, 1)
+                logger.info(f"Imported {name} in {IMPORT_TIMES[name]}ms")
+    return sys.modules[name]
+
+
+def _timed(name: str, fn):
+    start = time.perf_counter()
+    result = fn()
+    STATE["warmup_ms"][name] = round((time.perf_counter() - start) * 1000, 1)
+    return result
+
+
+def warm_up():
+    # runs off the event loop; everything here is blocking
+    from data_loader import get_client
+    from reranker import Reranker, get_model
+
+    # the cross-encoder decides readiness, a missing OpenAI key must not skip it
+    _timed("cross_encoder_load", lambda: get_model(retry=True))
+    reranker = Reranker()
+    _timed("cross_encoder_predict", reranker.warm_up)
+
+    try:
+        _timed("openai_client", get_client)
+    except Exception as e:
+        logger.warning(f"OpenAI client warm-up failed: {e}")
+
+
+async def _warm_up_in_background():
+    start = time.perf_counter()
+    delay = WARMUP_RETRY_S
+    while True:
+        STATE["attempts"] += 1
+        try:
+            await asyncio.to_thread(warm_up)
+            STATE["ready"] = True
+            STATE["error"] = None
+            break
+        except Exception as e:
+            # not-ready until a retry succeeds; queries that do arrive fall
+            # back to hybrid_no_rerank
+            logger.error(f"Warm-up failed, retrying in {delay}s: {e}")
+            STATE["error"] = str(e)
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, WARMUP_RETRY_MAX_S)
+    STATE["warmup_ms"]["total"] = round((time.perf_counter() - start) * 1000, 1)
+    logger.info(f"Warm-up finished: {STATE['warmup_ms']}")
+
+
+@asynccontextmanager
+async def lifespan(app):
+    task = None
+    if os.getenv("RAG_WARMUP", "1") != "0":
+        task = asyncio.create_task(_warm_up_in_background())
+    else:
+        STATE["ready"] = True
+    yield
+    if task and not task.done():
+        task.cancel()
+
+
+def readiness() -> dict:
+    return {
+        "ready": STATE["ready"],
+        "error": STATE["error"],
+        "attempts": STATE["attempts"],
+        "import_ms": dict(IMPORT_TIMES),
+        "warmup_ms": dict(STATE["warmup_ms"]),
+    }
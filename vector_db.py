@@ -1,6 +1,13 @@
 from qdrant_client import QdrantClient
-from qdrant_client.models import VectorParams, Distance, PointStruct
+from qdrant_client.models import VectorParams, Distance, PointStruct, SearchRequest
 import hashlib
+import uuid
+
+
+def chunk_id(source_id: str, index: int) -> str:
+    # deterministic point id for the index-th chunk of a document
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{source_id}:{index}"))
+
 
 class QdrantStorage: 
     # def __init__(self, url="http://localhost:6333", collection="docs", dim=1536):
@@ -60,18 +67,42 @@ class QdrantStorage:
             with_payload=True,
             limit=top_k
         )
+        return self._parse_results(results)
+
+    def search_batch(self, query_vectors, top_k:int = 5):
+        # one HTTP round trip for all queries
+        batch = self.client.search_batch(
+            collection_name=self.collection,
+            requests=[
+                SearchRequest(vector=v, limit=top_k, with_payload=True)
+                for v in query_vectors
+            ],
+        )
+        return [self._parse_results(results) for results in batch]
+
+    def _parse_results(self, results):
         contexts=[]
+        keys=[]
+        scores=[]
         sources=set()
 
         for r in results:
             payload = getattr(r, "payload", None) or {}
             text = payload.get("text", "")
+            chunk = payload.get("chunk")
             source = payload.get("source", "")
             if text:
                 contexts.append(text)
+            # docstore collections carry only the chunk index, not the text
+            if chunk is not None:
+                keys.append(chunk)
+                scores.append(r.score)
+            elif text:
+                keys.append(text)
+                scores.append(r.score)
             if source:
                 sources.add(source)
-        return {"contexts": contexts, "sources": list(sources)}
+        return {"contexts": contexts, "keys": keys, "scores": scores, "sources": list(sources)}
     
     def get_all_texts(self):
         scroll = self.client.scroll(
@@ -94,6 +125,27 @@ class QdrantStorage:
 
         return contexts, sources
 
+    def count(self):
+        return self.client.count(collection_name=self.collection, exact=True).count
+
+    def uses_docstore(self):
+        # docstore ingests mark every payload, checking one point is enough
+        points, _ = self.client.scroll(
+            collection_name=self.collection,
+            with_payload=True,
+            limit=1,
+        )
+        return bool(points) and bool((points[0].payload or {}).get("docstore"))
+
+    def get_texts_by_ids(self, ids):
+        records = self.client.retrieve(
+            collection_name=self.collection,
+            ids=ids,
+            with_payload=True,
+        )
+        by_id = {str(r.id): (r.payload or {}).get("text") for r in records}
+        return [by_id.get(str(i)) for i in ids]
+
     def collection_exists(self):
         existing = {
             c.name for c in self.client.get_collections().collections
@@ -115,8 +167,11 @@ class QdrantStorage:
         cols = self.client.get_collections().collections
         doc_cols = [c.name for c in cols if c.name.startswith("docs_")]
 
+        deleted = []
         if len(doc_cols) > keep_last:
             for c in sorted(doc_cols)[:-keep_last]:
                 self.client.delete_collection(c)
+                deleted.append(c)
+        return deleted
 
 